@@ -0,0 +1,282 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Catalog(object):
+    """ In-memory copy of the product library with hash indexes for fast lookups.
+    The catalog is loaded once from the API. After that, product changes made
+    through the catalog (create_product, update_product, delete_product etc.) are
+    passed to the client and applied to the indexes in place, so they never need
+    a full rebuild.
+
+    Names and category names are matched as-is, except that category names are
+    compared in upper case (iZettle converts all category names to upper case).
+
+    :param client: authenticated Izettle client
+    :Example:
+
+    >>> from iZettle.iZettle import Izettle
+    >>> from iZettle.catalog import Catalog
+    >>> catalog = Catalog(Izettle(...))
+    >>> for product, variant in catalog.find_by_barcode('6415712000032'):
+    ...     print(product['name'], variant['sku'])
+    """
+
+    def __init__(self, client):
+        """ Initialize the catalog and load everything from the API. """
+        self.client = client
+        self.load()
+
+    def load(self):
+        """ (Re)build all indexes from get_all_products, get_all_categroies and
+        get_all_discounts. This is only needed once, or if the catalog has been
+        changed outside of this object and you don't know what changed. """
+        self._products = {}
+        """ product uuid -> product dict """
+        self._variants = {}
+        """ variant uuid -> (product uuid, variant dict) """
+        self._by_name = {}
+        """ product name -> set of product uuids """
+        self._by_barcode = {}
+        """ barcode -> set of variant uuids """
+        self._by_sku = {}
+        """ sku -> set of variant uuids """
+        self._by_category = {}
+        """ category uuid -> set of product uuids. Products that refer to a category
+        name that is not in the catalog (yet) are under the upper case name. """
+        self._product_keys = {}
+        """ product uuid -> list of (index, key, value) entries added for the product """
+        self._categories = {}
+        """ category uuid -> category dict """
+        self._category_names = {}
+        """ upper case category name -> category uuid """
+        self._discounts = {}
+        """ discount uuid -> discount dict """
+
+        for category in self.client.get_all_categroies():
+            self.add_category(category)
+        for discount in self.client.get_all_discounts():
+            self.add_discount(discount)
+        for product in self.client.get_all_products():
+            self.add_product(product)
+
+        logger.info('catalog loaded: {} products, {} categories, {} discounts'.format(
+            len(self._products), len(self._categories), len(self._discounts)))
+
+    def add_product(self, product):
+        """ Add product (dict, as returned by get_product) to the indexes.
+        If the product is already in the catalog, it is replaced. """
+        product_uuid = product['uuid']
+        self.remove_product(product_uuid)
+        self._products[product_uuid] = product
+
+        entries = []
+        if product.get('name') is not None:
+            entries.append((self._by_name, product['name'], product_uuid))
+        for category_key in self._product_category_keys(product):
+            entries.append((self._by_category, category_key, product_uuid))
+        for variant in product.get('variants') or []:
+            self._variants[variant['uuid']] = (product_uuid, variant)
+            if variant.get('barcode'):
+                entries.append((self._by_barcode, variant['barcode'], variant['uuid']))
+            if variant.get('sku'):
+                entries.append((self._by_sku, variant['sku'], variant['uuid']))
+
+        for index, key, value in entries:
+            index.setdefault(key, set()).add(value)
+        self._product_keys[product_uuid] = entries
+
+    def remove_product(self, product_uuid):
+        """ Remove product from the indexes. Does nothing if it is not there. """
+        product = self._products.pop(product_uuid, None)
+        if product is None:
+            return
+
+        for variant in product.get('variants') or []:
+            self._variants.pop(variant['uuid'], None)
+
+        for index, key, value in self._product_keys.pop(product_uuid, []):
+            values = index.get(key)
+            if values is None:
+                continue
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def add_category(self, category):
+        """ Add category (dict, as returned by get_category) to the indexes.
+        If the category is already in the catalog, it is replaced. """
+        previous = self._categories.get(category['uuid'])
+        if previous and previous.get('name'):
+            if self._category_names.get(previous['name'].upper()) == category['uuid']:
+                del self._category_names[previous['name'].upper()]
+        self._categories[category['uuid']] = category
+        if category.get('name'):
+            name = category['name'].upper()
+            self._category_names[name] = category['uuid']
+            # products that were added before the category was known
+            self._move_category_key(name, category['uuid'])
+
+    def _move_category_key(self, old_key, new_key):
+        """ Move products from old_key to new_key in the category index. """
+        for product_uuid in self._by_category.pop(old_key, set()):
+            self._by_category.setdefault(new_key, set()).add(product_uuid)
+            self._product_keys[product_uuid] = [
+                (index, new_key if index is self._by_category and key == old_key else key, value)
+                for index, key, value in self._product_keys[product_uuid]]
+
+    def add_discount(self, discount):
+        """ Add discount (dict, as returned by get_discount) to the indexes.
+        If the discount is already in the catalog, it is replaced. """
+        self._discounts[discount['uuid']] = discount
+
+    def remove_discount(self, discount_uuid):
+        """ Remove discount from the indexes. Does nothing if it is not there. """
+        self._discounts.pop(discount_uuid, None)
+
+    def _product_category_keys(self, product):
+        """ All keys the product should be found with from the category index.
+        Products have either 'category' (dict with uuid and name) or the older
+        'categories' (list of category names). Names are resolved to category uuids
+        when the category is known. """
+        names = list(product.get('categories') or [])
+        category = product.get('category') or {}
+        keys = set()
+        if category.get('uuid'):
+            keys.add(category['uuid'])
+        elif category.get('name'):
+            names.append(category['name'])
+
+        for name in names:
+            keys.add(self._category_names.get(name.upper(), name.upper()))
+        return keys
+
+    def get_product(self, uuid):
+        """ :param uuid: product uuid, string
+        :return: product dict or None """
+        return self._products.get(uuid)
+
+    def get_product_by_variant(self, variant_uuid):
+        """ :param variant_uuid: variant uuid, string
+        :return: (product, variant) tuple or None """
+        if variant_uuid not in self._variants:
+            return None
+        product_uuid, variant = self._variants[variant_uuid]
+        return self._products[product_uuid], variant
+
+    def find_by_name(self, name):
+        """ :param name: exact product name, string
+        :return: list of products """
+        return [self._products[uuid] for uuid in self._by_name.get(name, ())]
+
+    def find_by_barcode(self, barcode):
+        """ :param barcode: variant barcode, string
+        :return: list of (product, variant) tuples """
+        return [self.get_product_by_variant(uuid) for uuid in self._by_barcode.get(barcode, ())]
+
+    def find_by_sku(self, sku):
+        """ :param sku: variant sku, string
+        :return: list of (product, variant) tuples """
+        return [self.get_product_by_variant(uuid) for uuid in self._by_sku.get(sku, ())]
+
+    def find_by_category(self, category):
+        """ :param category: category uuid or name (case insensitive), string
+        :return: list of products """
+        if category in self._categories:
+            key = category
+        else:
+            key = self._category_names.get(category.upper(), category.upper())
+        product_uuids = self._by_category.get(key, ())
+        return [self._products[uuid] for uuid in product_uuids]
+
+    def get_category(self, category):
+        """ :param category: category uuid or name (case insensitive), string
+        :return: category dict or None """
+        if category in self._categories:
+            return self._categories[category]
+        category_uuid = self._category_names.get(category.upper())
+        return self._categories.get(category_uuid)
+
+    def get_discount(self, uuid):
+        """ :param uuid: discount uuid, string
+        :return: discount dict or None """
+        return self._discounts.get(uuid)
+
+    def refresh_product(self, uuid):
+        """ Fetch a single product from the API and update it in the indexes.
+        Use this when you know a product was changed outside of the catalog.
+
+        :param uuid: product uuid, string
+        :return: product dict """
+        product = self.client.get_product(uuid)
+        self.add_product(product)
+        return product
+
+    def create_product(self, data=None):
+        """ Same as Izettle.create_product, but also adds the product to the catalog. """
+        response = self.client.create_product(data)
+        self.refresh_product(data['uuid'])
+        return response
+
+    def update_product(self, uuid, data=None):
+        """ Same as Izettle.update_product, but also updates the catalog. """
+        response = self.client.update_product(uuid, data)
+        self.refresh_product(uuid)
+        return response
+
+    def delete_product(self, uuid):
+        """ Same as Izettle.delete_product, but also removes the product from the catalog. """
+        response = self.client.delete_product(uuid)
+        self.remove_product(uuid)
+        return response
+
+    def delete_product_list(self, data=None):
+        """ Same as Izettle.delete_product_list, but also removes the products
+        from the catalog. """
+        response = self.client.delete_product_list(data)
+        for uuid in data['uuid']:
+            self.remove_product(uuid)
+        return response
+
+    def create_product_variant(self, product_uuid, data=None):
+        """ Same as Izettle.create_product_variant, but also updates the catalog. """
+        response = self.client.create_product_variant(product_uuid, data)
+        self.refresh_product(product_uuid)
+        return response
+
+    def update_product_variant(self, product_uuid, variant_uuid, data=None):
+        """ Same as Izettle.update_product_variant, but also updates the catalog. """
+        response = self.client.update_product_variant(product_uuid, variant_uuid, data)
+        self.refresh_product(product_uuid)
+        return response
+
+    def delete_product_variant(self, product_uuid, variant_uuid):
+        """ Same as Izettle.delete_product_variant, but also updates the catalog. """
+        response = self.client.delete_product_variant(product_uuid, variant_uuid)
+        self.refresh_product(product_uuid)
+        return response
+
+    def create_category(self, data=None):
+        """ Same as Izettle.create_category, but also adds the category to the catalog. """
+        response = self.client.create_category(data)
+        self.add_category(self.client.get_category(data['uuid']))
+        return response
+
+    def create_discount(self, data=None):
+        """ Same as Izettle.create_discount, but also adds the discount to the catalog. """
+        response = self.client.create_discount(data)
+        self.add_discount(self.client.get_discount(data['uuid']))
+        return response
+
+    def update_discount(self, uuid, data=None):
+        """ Same as Izettle.update_discount, but also updates the catalog. """
+        response = self.client.update_discount(uuid, data)
+        self.add_discount(self.client.get_discount(uuid))
+        return response
+
+    def delete_discount(self, uuid):
+        """ Same as Izettle.delete_discount, but also removes the discount from the catalog. """
+        response = self.client.delete_discount(uuid)
+        self.remove_discount(uuid)
+        return response
@@ -0,0 +1,320 @@
+import hashlib
+import hmac
+import json
+import logging
+import socket
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = 'X-iZettle-Signature'
+""" HTTP header iZettle uses for the message signature """
+
+MAX_BODY_SIZE = 1024 * 1024
+""" larger requests are rejected without reading them """
+
+
+class InvalidMessage(Exception):
+    """ Exception raised when a pushed message can not be accepted, because
+    it is not valid JSON, it is missing fields or the signature does not match. """
+    def __init__(self, msg, *args, **kwargs):
+        super(InvalidMessage, self).__init__(msg, *args, **kwargs)
+        self.msg = msg
+
+
+def sign(signing_key, timestamp, payload):
+    """ Calculate signature for a pushed message. iZettle signs the string
+    '<timestamp>.<payload>' with HMAC-SHA256 using the signing key of the
+    subscription. A stand-in publisher can use this to sign test messages.
+    https://github.com/iZettle/api-documentation/blob/master/pusher.adoc
+
+    :param signing_key: signing key of the subscription, string
+    :param timestamp: 'timestamp' field of the message, string
+    :param payload: 'payload' field of the message (JSON encoded), string
+    :return: hex digest, string """
+    message = u'{}.{}'.format(timestamp, payload)
+    return hmac.new(
+        signing_key.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+_EVENT_ENTITIES = {
+    'PurchaseCreated': None,
+    'ProductCreated': 'newEntity',
+    'ProductUpdated': 'newEntity',
+    'ProductDeleted': 'oldEntity',
+}
+""" handled events -> payload field that has the product """
+
+
+def _entity_uuid(event_name, payload):
+    """ uuid of the purchase or product the event is about, or None """
+    if event_name == 'PurchaseCreated':
+        return payload.get('purchaseUuid') or payload.get('purchaseUUID')
+    entity = payload.get(_EVENT_ENTITIES.get(event_name)) or payload
+    if isinstance(entity, dict):
+        return entity.get('uuid')
+    return None
+
+
+class Receiver(object):
+    """ Receives iZettle push notifications and turns them into purchase and
+    product callbacks, so new sales don't need to be polled for.
+
+    Pushed messages are verified and put to a queue by 'receive' (called by the
+    HTTP server, see 'make_server'). 'process' takes the events from the queue and
+    fetches the full purchase or product with the client, only for the entities
+    that changed. Events that fail (e.g. the API request fails) are put back to the
+    queue and retried on the next 'process', at most 'max_tries' times. 'catch_up'
+    polls get_multiple_purchases from 'cursor' to pick up purchases whose messages
+    were missed (or dropped), e.g. while the receiver was down.
+
+    :param client: Izettle client, used to fetch the changed entities
+    :param signing_key: signing key of the push subscription, string
+    :param on_purchase: called with purchase dict for every new purchase
+    :param on_product: called with product uuid and product dict for every created or
+    updated product, and with product uuid and None for a deleted product
+    :param catalog: optional Catalog that is kept up to date with product events
+    :param cursor: 'lastPurchaseHash' to continue catch_up from, string. Without
+    cursor, the first catch_up only finds the newest purchase and continues from there.
+    :Example:
+
+    >>> receiver = Receiver(client, signing_key, on_purchase=save_order)
+    >>> server = make_server(receiver, port=8000)
+    >>> threading.Thread(target=server.serve_forever).start()
+    >>> while True:
+    ...     receiver.process(block=True, timeout=600)
+    ...     receiver.catch_up()
+    """
+    max_seen = 10000
+    """ how many message and purchase uuids are remembered for skipping duplicates """
+    max_tries = 5
+    """ how many times an event is handled before it is dropped """
+
+    def __init__(self, client, signing_key, on_purchase=None, on_product=None,
+                 catalog=None, cursor=None):
+        self.client = client
+        self.signing_key = signing_key
+        self.on_purchase = on_purchase
+        self.on_product = on_product
+        self.catalog = catalog
+        self.cursor = cursor
+        """ 'lastPurchaseHash' of the last catch_up. Store this to resume later. """
+        self.events = queue.Queue()
+        """ (message, number of failed tries) of verified messages waiting for 'process' """
+        self._seen_messages = OrderedDict()
+        self._seen_messages_lock = threading.Lock()
+        self._seen_purchases = OrderedDict()
+
+    def receive(self, body, signature):
+        """ Verify a pushed message and put it to the event queue.
+
+        :param body: request body, string
+        :param signature: value of the X-iZettle-Signature header, string
+        :return: True if the message was queued, False if it was a duplicate """
+        try:
+            message = json.loads(body)
+            timestamp = message['timestamp']
+            payload = message['payload']
+            event_name = message['eventName']
+            payload_data = json.loads(payload)
+        except (ValueError, TypeError, KeyError):
+            raise InvalidMessage('invalid message')
+
+        expected = sign(self.signing_key, timestamp, payload)
+        try:
+            valid = hmac.compare_digest(expected.encode('ascii'), signature.encode('utf-8'))
+        except (AttributeError, UnicodeError):
+            # missing or non-ASCII header
+            valid = False
+        if not valid:
+            raise InvalidMessage('invalid signature')
+
+        if not isinstance(payload_data, dict):
+            raise InvalidMessage('invalid payload')
+        if event_name in _EVENT_ENTITIES and not _entity_uuid(event_name, payload_data):
+            raise InvalidMessage('missing uuid in {}'.format(event_name))
+
+        with self._seen_messages_lock:
+            if not self._remember(self._seen_messages, message.get('messageUuid')):
+                logger.info('duplicate message {}'.format(message.get('messageUuid')))
+                return False
+
+        logger.info('received {}'.format(event_name))
+        self.events.put((message, 0))
+        return True
+
+    def process(self, block=False, timeout=None):
+        """ Handle queued events. Fetches full purchase or product for each event
+        and passes it to on_purchase/on_product (and to the catalog).
+
+        :param block: wait for at least one event, if the queue is empty
+        :param timeout: how long to wait with block (seconds), None waits forever
+        :return: number of successfully handled events """
+        handled = 0
+        failed = []
+        while True:
+            try:
+                message, tries = self.events.get(block=block and not handled and not failed,
+                                                 timeout=timeout)
+            except queue.Empty:
+                break
+            try:
+                self._handle(message)
+                handled += 1
+            except Exception:
+                tries += 1
+                if tries >= self.max_tries:
+                    logger.exception('failed to handle {} {} times, dropping it: {}'.format(
+                        message['eventName'], tries, message['payload']))
+                    continue
+                logger.exception('failed to handle {}, will retry'.format(message['eventName']))
+                failed.append((message, tries))
+
+        for item in failed:
+            self.events.put(item)
+        return handled
+
+    def catch_up(self, limit=100):
+        """ Poll purchases made after 'cursor' and pass the ones not yet seen to
+        on_purchase. Without cursor, this only stores the newest purchase as the
+        cursor, so that the purchase history is not replayed.
+
+        :param limit: page size for get_multiple_purchases, int
+        :return: number of new purchases """
+        if not self.cursor:
+            response = self.client.get_multiple_purchases({'limit': 1, 'descending': True})
+            self.cursor = response.get('lastPurchaseHash')
+            return 0
+
+        new_purchases = 0
+        while True:
+            data = {'limit': limit, 'lastPurchaseHash': self.cursor}
+            response = self.client.get_multiple_purchases(data)
+            purchases = response.get('purchases') or []
+
+            for purchase in purchases:
+                if purchase['purchaseUUID'] not in self._seen_purchases:
+                    self._call(self.on_purchase, purchase)
+                    self._remember(self._seen_purchases, purchase['purchaseUUID'])
+                    new_purchases += 1
+
+            cursor = response.get('lastPurchaseHash')
+            if not cursor or cursor == self.cursor:
+                return new_purchases
+            self.cursor = cursor
+            if len(purchases) < limit:
+                return new_purchases
+
+    def _handle(self, message):
+        """ Fetch the entity the message is about and call the callbacks. """
+        event_name = message['eventName']
+        entity_uuid = _entity_uuid(event_name, json.loads(message['payload']))
+
+        if event_name == 'PurchaseCreated':
+            purchase_uuid = entity_uuid
+            if purchase_uuid in self._seen_purchases:
+                return
+            purchase = self.client.get_purchase(purchase_uuid)
+            if purchase['purchaseUUID'] not in self._seen_purchases:
+                self._call(self.on_purchase, purchase)
+                self._remember(self._seen_purchases, purchase['purchaseUUID'])
+
+        elif event_name in ('ProductCreated', 'ProductUpdated'):
+            product = self.client.get_product(entity_uuid)
+            if self.catalog is not None:
+                self.catalog.add_product(product)
+            self._call(self.on_product, product['uuid'], product)
+
+        elif event_name == 'ProductDeleted':
+            if self.catalog is not None:
+                self.catalog.remove_product(entity_uuid)
+            self._call(self.on_product, entity_uuid, None)
+
+        else:
+            logger.info('ignored event {}'.format(event_name))
+
+    def _call(self, callback, *args):
+        if callback is not None:
+            callback(*args)
+
+    def _remember(self, seen, key):
+        """ Add key to seen uuids. Returns False if it was already there. """
+        if key is None:
+            return True
+        if key in seen:
+            return False
+        seen[key] = True
+        if len(seen) > self.max_seen:
+            seen.popitem(last=False)
+        return True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ Passes POSTed messages to server.receiver """
+    timeout = 10
+    """ socket timeout (seconds), so that a slow client can't keep the connection """
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0 or length > MAX_BODY_SIZE:
+                raise ValueError('invalid Content-Length')
+            body = self.rfile.read(length).decode('utf-8')
+        except ValueError:
+            # invalid Content-Length or body that isn't UTF-8
+            logger.info('rejected request: invalid body')
+            self.send_response(400)
+            self.end_headers()
+            return
+        except socket.timeout:
+            logger.info('rejected request: timed out')
+            self.close_connection = True
+            return
+
+        try:
+            self.server.receiver.receive(body, self.headers.get(SIGNATURE_HEADER))
+        except InvalidMessage as e:
+            logger.info('rejected message: {}'.format(e.msg))
+            self.send_response(400)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.info(format % args)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """ HTTP server that handles each request in its own thread """
+    daemon_threads = True
+
+
+def make_server(receiver, host='', port=8000):
+    """ Create HTTP server that passes pushed messages to the receiver.
+    Call serve_forever() on the returned server (in a thread, if you want to
+    process events in the same program) and shutdown() to stop it.
+
+    :param receiver: Receiver
+    :param host: address to listen, string
+    :param port: port to listen, int. 0 picks a free port (see server.server_port)
+    :return: HTTPServer """
+    server = _Server((host, port), _RequestHandler)
+    server.receiver = receiver
+    return server
@@ -1,10 +1,17 @@
+# -*- coding: utf-8 -*-
 import os
 import sys
+import json
+import socket
+import threading
 import unittest
 import logging
 import uuid
 import time
+import requests
 from iZettle.iZettle import Izettle, RequestException
+from iZettle.catalog import Catalog
+from iZettle.receiver import Receiver, InvalidMessage, make_server, sign, SIGNATURE_HEADER
 
 logger = logging.getLogger()
 logger.level = logging.DEBUG
@@ -188,6 +195,81 @@ class TestIzettle(unittest.TestCase):
         single_purchase = c.get_purchase(purchase_uuid1)
         self.assertEqual(purchase_uuid, single_purchase['purchaseUUID'])
 
+    def test_catalog(self):
+        catalog = Catalog(self.client)
+        self.assertEqual(len(catalog.find_by_name('no such product name')), 0)
+
+        product_uuid = str(uuid.uuid1())
+        variant_uuid = str(uuid.uuid1())
+        barcode = str(uuid.uuid1())
+        sku = str(uuid.uuid1())
+        catalog.create_product({
+            'uuid': product_uuid,
+            'name': 'catalog product',
+            'variants': [{'uuid': variant_uuid, 'barcode': barcode, 'sku': sku}],
+        })
+        self.assertEqual(catalog.get_product(product_uuid)['uuid'], product_uuid)
+        product, variant = catalog.get_product_by_variant(variant_uuid)
+        self.assertEqual(product['uuid'], product_uuid)
+        self.assertEqual(variant['uuid'], variant_uuid)
+        self.assertEqual(catalog.find_by_barcode(barcode)[0][0]['uuid'], product_uuid)
+        self.assertEqual(catalog.find_by_sku(sku)[0][1]['uuid'], variant_uuid)
+        self.assertIn(product_uuid, [p['uuid'] for p in catalog.find_by_name('catalog product')])
+
+        catalog.update_product(product_uuid, {'name': 'updated catalog product'})
+        self.assertNotIn(product_uuid, [p['uuid'] for p in catalog.find_by_name('catalog product')])
+        self.assertIn(
+            product_uuid, [p['uuid'] for p in catalog.find_by_name('updated catalog product')])
+
+        catalog.delete_product(product_uuid)
+        self.assertIsNone(catalog.get_product(product_uuid))
+        self.assertIsNone(catalog.get_product_by_variant(variant_uuid))
+        self.assertEqual(catalog.find_by_barcode(barcode), [])
+        self.assertEqual(catalog.find_by_sku(sku), [])
+
+    def test_receiver(self):
+        """ Push messages to the receiver from a local stand-in publisher """
+        c = self.client
+        signing_key = 'test signing key'
+        purchases = []
+        receiver = Receiver(c, signing_key, on_purchase=purchases.append)
+        server = make_server(receiver, host='127.0.0.1', port=0)
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        purchase_uuid = c.get_multiple_purchases({'limit': 1})['purchases'][0]['purchaseUUID']
+        payload = json.dumps({'purchaseUuid': purchase_uuid})
+        timestamp = '2018-01-01T00:00:00.000Z'
+        message = json.dumps({
+            'messageUuid': str(uuid.uuid1()),
+            'eventName': 'PurchaseCreated',
+            'timestamp': timestamp,
+            'payload': payload,
+        })
+
+        response = requests.post(url, data=message, headers={SIGNATURE_HEADER: 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(receiver.process(), 0)
+
+        signature = sign(signing_key, timestamp, payload)
+        response = requests.post(url, data=message, headers={SIGNATURE_HEADER: signature})
+        self.assertEqual(response.status_code, 200)
+        # the same message again is accepted, but not queued twice
+        response = requests.post(url, data=message, headers={SIGNATURE_HEADER: signature})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(receiver.events.qsize(), 1)
+
+        self.assertEqual(receiver.process(block=True, timeout=10), 1)
+        self.assertEqual(len(purchases), 1)
+        self.assertEqual(purchases[0]['purchaseUUID'], purchase_uuid)
+
+        # without cursor, catch up starts from the newest purchase
+        self.assertEqual(receiver.catch_up(), 0)
+        self.assertIsNotNone(receiver.cursor)
+        self.assertEqual(len(purchases), 1)
+
     @unittest.skip('This will take over 2 hours.')
     def test_session(self):
         """ This tests if the integration works if the session expires before we
@@ -198,5 +280,274 @@ class TestIzettle(unittest.TestCase):
         self.assertIsNotNone(self.client.get_all_products())
 
 
+class StubClient(object):
+    """ Stand-in for Izettle client, for tests that don't need the API """
+    def __init__(self, products=None, categories=None, purchases=None):
+        self.products = products or {}
+        self.categories = categories or []
+        self.purchases = purchases or []
+        self.requests = []
+
+    def get_all_categroies(self):
+        return self.categories
+
+    def get_all_discounts(self):
+        return []
+
+    def get_all_products(self):
+        return list(self.products.values())
+
+    def get_product(self, uuid):
+        self.requests.append(('get_product', uuid))
+        return self.products[uuid]
+
+    def get_purchase(self, uuid):
+        self.requests.append(('get_purchase', uuid))
+        for purchase in self.purchases:
+            if purchase['purchaseUUID'] == uuid:
+                return purchase
+        raise requests.exceptions.Timeout()
+
+    def get_multiple_purchases(self, data=None):
+        """ Pages through 'purchases'. 'lastPurchaseHash' is the purchase uuid. """
+        self.requests.append(('get_multiple_purchases', data))
+        uuids = [purchase['purchaseUUID'] for purchase in self.purchases]
+        if data.get('descending'):
+            page = list(reversed(self.purchases))[:data['limit']]
+        else:
+            start = 0
+            if data.get('lastPurchaseHash'):
+                start = uuids.index(data['lastPurchaseHash']) + 1
+            page = self.purchases[start:start + data['limit']]
+        response = {'purchases': page}
+        if page:
+            response['lastPurchaseHash'] = page[-1]['purchaseUUID']
+        return response
+
+
+class TestCatalog(unittest.TestCase):
+    def find_by_category(self, catalog, category):
+        return sorted(product['uuid'] for product in catalog.find_by_category(category))
+
+    def test_category(self):
+        client = StubClient(
+            categories=[{'uuid': 'c1', 'name': 'SHOES'}],
+            products={
+                'p1': {'uuid': 'p1', 'categories': ['shoes']},
+                'p2': {'uuid': 'p2', 'category': {'uuid': 'c1', 'name': 'SHOES'}},
+                'p3': {'uuid': 'p3', 'categories': ['unknown']},
+            })
+        catalog = Catalog(client)
+        self.assertEqual(self.find_by_category(catalog, 'c1'), ['p1', 'p2'])
+        self.assertEqual(self.find_by_category(catalog, 'Shoes'), ['p1', 'p2'])
+        self.assertEqual(self.find_by_category(catalog, 'unknown'), ['p3'])
+
+        catalog.remove_product('p1')
+        self.assertEqual(self.find_by_category(catalog, 'c1'), ['p2'])
+
+    def test_renamed_category(self):
+        client = StubClient(products={'p1': {'uuid': 'p1', 'categories': ['shoes']}})
+        catalog = Catalog(client)
+        self.assertEqual(self.find_by_category(catalog, 'shoes'), ['p1'])
+
+        # category is created after the product
+        catalog.add_category({'uuid': 'c1', 'name': 'SHOES'})
+        self.assertEqual(self.find_by_category(catalog, 'c1'), ['p1'])
+        self.assertEqual(self.find_by_category(catalog, 'shoes'), ['p1'])
+
+        catalog.add_category({'uuid': 'c1', 'name': 'BOOTS'})
+        self.assertIsNone(catalog.get_category('shoes'))
+        self.assertEqual(catalog.get_category('boots')['uuid'], 'c1')
+        self.assertEqual(self.find_by_category(catalog, 'c1'), ['p1'])
+        self.assertEqual(self.find_by_category(catalog, 'boots'), ['p1'])
+        self.assertEqual(self.find_by_category(catalog, 'shoes'), [])
+
+        catalog.remove_product('p1')
+        self.assertEqual(self.find_by_category(catalog, 'c1'), [])
+        self.assertEqual(catalog._by_category, {})
+
+
+class TestReceiver(unittest.TestCase):
+    """ Receiver tests with a stub client and a local stand-in publisher """
+    signing_key = 'test signing key'
+
+    def setUp(self):
+        self.client = StubClient(
+            products={'p1': {'uuid': 'p1', 'name': u'Äänikirja', 'variants': []}},
+            purchases=[{'purchaseUUID': 'a'}],
+        )
+        self.purchases = []
+        self.products = []
+        self.receiver = Receiver(
+            self.client, self.signing_key,
+            on_purchase=self.purchases.append,
+            on_product=lambda uuid, product: self.products.append((uuid, product)),
+        )
+
+    def message(self, event_name, payload):
+        """ Signed message like iZettle would push it. Returns (body, signature) """
+        payload = json.dumps(payload, ensure_ascii=False)
+        timestamp = '2018-01-01T00:00:00.000Z'
+        body = json.dumps({
+            'messageUuid': str(uuid.uuid1()),
+            'eventName': event_name,
+            'timestamp': timestamp,
+            'payload': payload,
+        })
+        return body, sign(self.signing_key, timestamp, payload)
+
+    def test_publish(self):
+        server = make_server(self.receiver, host='127.0.0.1', port=0)
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        body, signature = self.message('PurchaseCreated', {'purchaseUuid': 'a'})
+        response = requests.post(url, data=body, headers={SIGNATURE_HEADER: 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        response = requests.post(url, data=b'\xff', headers={SIGNATURE_HEADER: signature})
+        self.assertEqual(response.status_code, 400)
+        response = requests.post(url, data=body, headers={SIGNATURE_HEADER: signature})
+        self.assertEqual(response.status_code, 200)
+        response = requests.post(url, data=body, headers={SIGNATURE_HEADER: signature})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.receiver.process(), 1)
+        self.assertEqual(self.purchases, [{'purchaseUUID': 'a'}])
+
+    def test_publish_invalid_request(self):
+        server = make_server(self.receiver, host='127.0.0.1', port=0)
+        threading.Thread(target=server.serve_forever).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+        def post(headers, body=b''):
+            """ Send raw request, return the status line """
+            connection = socket.create_connection(('127.0.0.1', server.server_port), timeout=5)
+            connection.sendall(b'POST / HTTP/1.1\r\n' + headers + b'\r\n\r\n' + body)
+            response = connection.recv(1024).split(b'\r\n')[0]
+            connection.close()
+            return response
+
+        body, signature = self.message('PurchaseCreated', {'purchaseUuid': 'a'})
+        body = body.encode('utf-8')
+        length = 'Content-Length: {}\r\n'.format(len(body)).encode('ascii')
+        self.assertIn(b' 400 ', post(length + b'X-iZettle-Signature: \xc3\xa9', body))
+        self.assertIn(b' 400 ', post(b'Content-Length: -1'))
+        self.assertIn(b' 400 ', post(b'Content-Length: 100000000'))
+        self.assertIn(b' 400 ', post(b'Content-Length: x'))
+
+        # a client that doesn't send the body doesn't block other requests
+        slow = socket.create_connection(('127.0.0.1', server.server_port))
+        self.addCleanup(slow.close)
+        slow.sendall(b'POST / HTTP/1.1\r\nContent-Length: 100\r\n\r\n')
+        response = requests.post(url, data=body, headers={SIGNATURE_HEADER: signature},
+                                 timeout=5)
+        self.assertEqual(response.status_code, 200)
+
+    def test_duplicate_message(self):
+        body, signature = self.message('PurchaseCreated', {'purchaseUuid': 'a'})
+        self.assertTrue(self.receiver.receive(body, signature))
+        self.assertFalse(self.receiver.receive(body, signature))
+        with self.assertRaises(InvalidMessage):
+            self.receiver.receive(body, 'invalid')
+        with self.assertRaises(InvalidMessage):
+            self.receiver.receive(body, None)
+        with self.assertRaises(InvalidMessage):
+            self.receiver.receive(body, u'\xe9')
+        with self.assertRaises(InvalidMessage):
+            self.receiver.receive('not json', signature)
+
+    def test_invalid_payload(self):
+        invalid_messages = [
+            self.message('PurchaseCreated', []),
+            self.message('PurchaseCreated', {}),
+            self.message('ProductUpdated', {'newEntity': {}}),
+            self.message('ProductDeleted', {'oldEntity': 'p1'}),
+        ]
+        for body, signature in invalid_messages:
+            with self.assertRaises(InvalidMessage):
+                self.receiver.receive(body, signature)
+        self.assertEqual(self.receiver.events.qsize(), 0)
+
+        # other events are accepted and ignored
+        self.assertTrue(self.receiver.receive(*self.message('InventoryBalanceChanged', {})))
+        self.assertEqual(self.receiver.process(), 1)
+
+    def test_failing_event_is_dropped(self):
+        self.receiver.max_tries = 3
+        self.receiver.receive(*self.message('PurchaseCreated', {'purchaseUuid': 'b'}))
+        for i in range(2):
+            self.assertEqual(self.receiver.process(), 0)
+            self.assertEqual(self.receiver.events.qsize(), 1)
+        self.assertEqual(self.receiver.process(), 0)
+        self.assertEqual(self.receiver.events.qsize(), 0)
+        self.assertEqual(len(self.client.requests), 3)
+
+    def test_failed_fetch_keeps_event(self):
+        self.receiver.receive(*self.message('PurchaseCreated', {'purchaseUuid': 'b'}))
+        self.receiver.receive(*self.message('PurchaseCreated', {'purchaseUuid': 'a'}))
+        self.assertEqual(self.receiver.process(), 1)
+        self.assertEqual(self.receiver.events.qsize(), 1)
+        self.assertEqual(self.purchases, [{'purchaseUUID': 'a'}])
+
+        self.client.purchases.append({'purchaseUUID': 'b'})
+        self.assertEqual(self.receiver.process(), 1)
+        self.assertEqual(self.receiver.events.qsize(), 0)
+        self.assertEqual(self.purchases, [{'purchaseUUID': 'a'}, {'purchaseUUID': 'b'}])
+
+    def test_failed_callback_keeps_purchase_unseen(self):
+        def on_purchase(purchase):
+            raise ValueError('database is down')
+        self.receiver.on_purchase = on_purchase
+        self.receiver.receive(*self.message('PurchaseCreated', {'purchaseUuid': 'a'}))
+        self.assertEqual(self.receiver.process(), 0)
+
+        self.receiver.on_purchase = self.purchases.append
+        self.assertEqual(self.receiver.process(), 1)
+        self.assertEqual(self.purchases, [{'purchaseUUID': 'a'}])
+
+    def test_product_events_update_catalog(self):
+        catalog = Catalog(self.client)
+        self.receiver.catalog = catalog
+        self.client.products['p2'] = {'uuid': 'p2', 'name': 'new', 'variants': []}
+        self.client.products['p1']['name'] = 'renamed'
+
+        self.receiver.receive(*self.message('ProductCreated', {'uuid': 'p2'}))
+        self.receiver.receive(*self.message('ProductUpdated', {'newEntity': {'uuid': 'p1'}}))
+        self.assertEqual(self.receiver.process(), 2)
+        self.assertEqual(catalog.find_by_name('new')[0]['uuid'], 'p2')
+        self.assertEqual(catalog.find_by_name('renamed')[0]['uuid'], 'p1')
+        self.assertEqual(catalog.find_by_name(u'Äänikirja'), [])
+
+        self.receiver.receive(*self.message('ProductDeleted', {'oldEntity': {'uuid': 'p1'}}))
+        self.assertEqual(self.receiver.process(), 1)
+        self.assertIsNone(catalog.get_product('p1'))
+        self.assertEqual([uuid for uuid, product in self.products], ['p2', 'p1', 'p1'])
+        self.assertIsNone(self.products[-1][1])
+
+    def test_catch_up(self):
+        # without cursor, only the newest purchase is looked up
+        self.assertEqual(self.receiver.catch_up(), 0)
+        self.assertEqual(self.receiver.cursor, 'a')
+        self.assertEqual(self.purchases, [])
+
+        self.client.purchases.extend({'purchaseUUID': str(i)} for i in range(5))
+        self.assertEqual(self.receiver.catch_up(limit=2), 5)
+        self.assertEqual(self.receiver.cursor, '4')
+        self.assertEqual(self.receiver.catch_up(limit=2), 0)
+
+    def test_catch_up_stops_when_cursor_does_not_move(self):
+        def get_multiple_purchases(data=None):
+            self.client.requests.append(data)
+            return {'purchases': [{'purchaseUUID': 'x'}, {'purchaseUUID': 'y'}]}
+        self.client.get_multiple_purchases = get_multiple_purchases
+        self.receiver.cursor = 'a'
+        self.assertEqual(self.receiver.catch_up(limit=2), 2)
+        self.assertEqual(len(self.client.requests), 1)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)